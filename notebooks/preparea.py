@@ -4,9 +4,41 @@
 # In[3]:
 
 
+import asyncio
+import csv
+import functools
+import io
+import json
+import os
+import pathlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import pandas as pd
 import numpy as np
 
+try:
+    import requests
+except ImportError:
+    requests = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa_csv = None
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
 DOWNLOAD_URL = (
     "https://raw.githubusercontent.com/CSSEGISandData/COVID-19/"
     "master/csse_covid_19_data/csse_covid_19_time_series/"
@@ -24,12 +56,480 @@ REPLACE_AREA = {
     "Grand Princess": "Cruise Ship",
     "MS Zaandam": "Cruise Ship"}
 
+LABELS = "Country/Region", "Province_State"
+DATE_FORMAT = "%m/%d/%y"
+
 directory='data/raw'
 
+def rename_area(area):
+    """
+    Returns the REPLACE_AREA name for area, or area itself if it isn't
+    being replaced
+    """
+    return REPLACE_AREA.get(area, area)
+
+def is_date_column(cols):
+    """
+    Finds the date columns, whose John Hopkins M/D/YY names are the only
+    ones containing two slashes
+
+    Parameters
+    ----------
+    cols : list or Index of column names
+
+    Returns
+    -------
+    boolean array
+    """
+    if isinstance(cols, pd.Index):
+        cols = cols.tolist()
+    return np.array([col.count('/') == 2 for col in cols], dtype=bool)
+
+def read_header(source):
+    """
+    Reads just the header row of a CSV
+
+    Parameters
+    ----------
+    source : path or binary file-like object of the CSV
+
+    Returns
+    -------
+    list of column names
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, newline='') as f:
+            return next(csv.reader(f))
+    pos = source.tell()
+    line = source.readline().decode('utf-8-sig')
+    source.seek(pos)
+    return next(csv.reader([line]))
+
+def read_csv(source):
+    """
+    Reads a raw John Hopkins CSV into a DataFrame with the multithreaded
+    pyarrow parser, falling back to pandas when pyarrow is not installed.
+
+    Only the area label and the date columns are parsed, the dates as
+    int32, since those are the only columns `select_columns` keeps.
+    Blank counts are read as 0, which is what summing them used to give.
+
+    Parameters
+    ----------
+    source : path or binary file-like object of the CSV
+
+    Returns
+    -------
+    DataFrame
+    """
+    header = read_header(source)
+    is_date = is_date_column(header)
+    date_cols = [col for col, date in zip(header, is_date) if date]
+    keep = [col for col, date in zip(header, is_date) if date or col in LABELS]
+    if pa_csv is None:
+        pos = None if isinstance(source, (str, os.PathLike)) else source.tell()
+        try:
+            return pd.read_csv(source, usecols=keep,
+                               dtype={col: np.int32 for col in date_cols})
+        except ValueError:
+            # an int32 column can't hold a blank, so parse that file again
+            # letting pandas infer the types and fill the blanks afterwards
+            if pos is not None:
+                source.seek(pos)
+            df = pd.read_csv(source, usecols=keep)
+            df[date_cols] = df[date_cols].fillna(0).astype(np.int32)
+            return df
+    table = pa_csv.read_csv(
+        source,
+        read_options=pa_csv.ReadOptions(use_threads=True, block_size=1 << 20),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=keep,
+            column_types={col: pa.int32() for col in date_cols},
+            strings_can_be_null=True))
+    for i, name in enumerate(table.column_names):
+        col = table.column(i)
+        if col.null_count and name in date_cols:
+            table = table.set_column(i, name, pc.fill_null(col, 0))
+    return table.to_pandas()
+
+def _fix_monotone_numpy(arr):
+    n = arr.shape[0]
+    # fmax skips NaN, and NaN compares False, so missing values are gaps
+    valid = arr >= np.fmax.accumulate(arr, axis=0)
+    idx = np.arange(n)[:, None]
+    # the first row is checked to have no NaN and always equals its running
+    # maximum, so every position has a valid value at or before it
+    left_idx = np.maximum.accumulate(np.where(valid, idx, 0), axis=0)
+    right_idx = np.minimum.accumulate(
+        np.where(valid, idx, n)[::-1], axis=0)[::-1]
+    right_idx = np.where(right_idx == n, left_idx, right_idx)
+    left = np.take_along_axis(arr, left_idx, axis=0)
+    right = np.take_along_axis(arr, right_idx, axis=0)
+    span = right_idx - left_idx
+    frac = np.divide(idx - left_idx, span, out=np.zeros(arr.shape),
+                     where=span > 0)
+    return np.round(left + (right - left) * frac).astype('int64')
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _fix_monotone_kernel(arr, out):
+        n, ncols = arr.shape
+        for j in numba.prange(ncols):
+            cm = arr[0, j]
+            left_i = 0
+            out[0, j] = arr[0, j]
+            for i in range(1, n):
+                v = arr[i, j]
+                # NaN (v != v) and dips below the running maximum are gaps
+                if v != v or v < cm:
+                    continue
+                cm = v
+                # fill the gap since the last valid value
+                span = i - left_i
+                left = arr[left_i, j]
+                for k in range(left_i + 1, i):
+                    out[k, j] = left + (v - left) * ((k - left_i) / span)
+                out[i, j] = v
+                left_i = i
+            for k in range(left_i + 1, n):
+                out[k, j] = arr[left_i, j]
+
+def fix_monotone(arr):
+    """
+    Replaces each value lower than the running maximum of its column, and
+    each missing value, by linearly interpolating between the surrounding
+    valid values. Trailing bad values take the last valid value.
+    Columns can't start with a missing value since there would be nothing
+    to fill it from.
+
+    Parameters
+    ----------
+    arr : 2D array with time along the first axis
+
+    Returns
+    -------
+    2D int64 array
+    """
+    arr = arr.astype('float64')
+    if len(arr) and np.isnan(arr[0]).any():
+        raise ValueError('cannot fix columns whose first value is missing')
+    if numba is None:
+        return _fix_monotone_numpy(arr)
+    out = np.empty_like(arr)
+    _fix_monotone_kernel(arr, out)
+    return np.round(out).astype('int64')
+
+def group_sum(keys, values):
+    """
+    Sums the rows of values that share the same key. Rows with a missing
+    key are dropped and missing values count as 0, as in groupby.sum.
+
+    Parameters
+    ----------
+    keys : 1D array of area labels
+
+    values : 2D array with one row per key
+
+    Returns
+    -------
+    sorted array of unique keys, 2D array of totals, int64 for integer
+    values and float64 otherwise
+    """
+    filt = pd.notna(keys)
+    keys = keys[filt]
+    # a stable sort puts each area's rows next to each other so a
+    # single reduceat sums every group
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    values = values[filt][order]
+    areas, start = np.unique(keys, return_index=True)
+    if values.dtype.kind in 'iub':
+        return areas, np.add.reduceat(values, start, axis=0, dtype='int64')
+    values = np.where(np.isnan(values), 0, values)
+    return areas, np.add.reduceat(values, start, axis=0, dtype='float64')
+
+def clean(df):
+    """
+    Runs select_columns, update_areas, group_area, transpose_to_ts and
+    fix_bad_data in a single pass over the raw values, building only the
+    final DataFrame
+
+    Parameters
+    ----------
+    df : raw DataFrame
+
+    Returns
+    -------
+    DataFrame
+    """
+    return clean_group([df])[0]
+
+def clean_group(frames):
+    """
+    Cleans several raw DataFrames of the same group, i.e. the deaths and
+    cases of "world". When they share the same rows and columns their
+    values are stacked so the labels are only grouped and the dates only
+    parsed once for all of them.
+
+    Parameters
+    ----------
+    frames : list of raw DataFrames
+
+    Returns
+    -------
+    list of DataFrames
+    """
+    df = frames[0]
+    cols = df.columns
+    is_label = cols.isin(LABELS)
+    is_date = is_date_column(cols)
+    first_col = cols[is_label | is_date][0]
+    shared = all(other.columns.equals(cols)
+                 and other[first_col].equals(df[first_col])
+                 for other in frames[1:])
+    if not shared:
+        return [clean(other) for other in frames]
+
+    # rename the distinct labels rather than every row, merging the areas
+    # REPLACE_AREA maps to the same name into a single category code
+    cat = pd.Categorical(df[first_col])
+    names = cat.categories.map(rename_area)
+    areas, remap = np.unique(names.to_numpy(dtype=object), return_inverse=True)
+    codes = remap[cat.codes]
+    filt = (cat.codes != -1) & (areas[codes] != 'US')
+    # (rows, dates, frames) so one sort and one reduceat cover every frame
+    values = np.stack([other.iloc[:, is_date].to_numpy()[filt]
+                       for other in frames], axis=-1)
+    area_codes, totals = group_sum(codes[filt], values)
+    n_areas, n_dates, n_frames = totals.shape
+    # lay the frames out side by side as (dates, areas * frames) columns
+    fixed = fix_monotone(totals.transpose(1, 0, 2).reshape(n_dates, -1))
+    index = pd.to_datetime(cols[is_date], format=DATE_FORMAT, cache=True)
+    columns = pd.Index(areas[area_codes], name=first_col)
+    return [pd.DataFrame(fixed[:, i::n_frames], index=index, columns=columns)
+            for i in range(n_frames)]
+
+HTTP_CACHE_FILE = f'{directory}/.http_cache.json'
+_http_cache_lock = threading.Lock()
+
+def _read_http_cache():
+    try:
+        with open(HTTP_CACHE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def data_source(group, kind):
+    """
+    Finds where a dataset lives upstream and where its download is cached
+
+    Parameters
+    ----------
+    group : "world" or "usa"
+
+    kind : "deaths" or "cases"
+
+    Returns
+    -------
+    url, cache_path
+    """
+    cache_path = f'{directory}/.http_cache/{group}_{kind}.csv'
+    group = 'US' if group == 'usa' else 'global'
+    kind = 'confirmed' if kind == 'cases' else 'deaths'
+    return DOWNLOAD_URL.format(kind, group), cache_path
+
+def _conditional_headers(url, cache_path):
+    with _http_cache_lock:
+        entry = _read_http_cache().get(url, {})
+    headers = {}
+    if os.path.exists(cache_path):
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+def _store(url, cache_path, body, headers):
+    # write to a temporary file first so an interrupted download never
+    # leaves a truncated CSV behind
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = f'{cache_path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(body)
+    os.replace(tmp_path, cache_path)
+
+    with _http_cache_lock:
+        cache = _read_http_cache()
+        cache[url] = {'etag': headers.get('ETag'),
+                      'last_modified': headers.get('Last-Modified')}
+        with open(HTTP_CACHE_FILE, 'w') as f:
+            json.dump(cache, f, indent=2)
+
+def fetch(url, cache_path):
+    """
+    Downloads a CSV with a conditional GET, reusing the copy saved at
+    cache_path when the server reports it has not changed. Without
+    requests installed this is a plain `download`
+
+    Parameters
+    ----------
+    url : string url of the CSV
+
+    cache_path : string path where the downloaded CSV is kept
+
+    Returns
+    -------
+    DataFrame
+    """
+    if requests is None:
+        return download(url)
+    headers = _conditional_headers(url, cache_path)
+    resp = requests.get(url, headers=headers, timeout=60)
+    if resp.status_code != 304:
+        resp.raise_for_status()
+        _store(url, cache_path, resp.content, resp.headers)
+    return read_csv(cache_path)
+
+def download(url):
+    """
+    Downloads a CSV without touching the HTTP cache, letting pandas read
+    the url itself when requests is not installed
+
+    Parameters
+    ----------
+    url : string url of the CSV
+
+    Returns
+    -------
+    DataFrame
+    """
+    if requests is None:
+        return pd.read_csv(url)
+    resp = requests.get(url, timeout=60)
+    resp.raise_for_status()
+    return read_csv(io.BytesIO(resp.content))
+
+def read_local(parquet_path, csv_path):
+    """
+    Reads the Parquet file when it exists and is at least as new as the
+    CSV, and the CSV otherwise
+
+    Parameters
+    ----------
+    parquet_path : path of the Parquet copy
+
+    csv_path : path of the CSV
+
+    Returns
+    -------
+    DataFrame
+    """
+    if os.path.exists(parquet_path) and (
+            not os.path.exists(csv_path)
+            or os.path.getmtime(parquet_path) >= os.path.getmtime(csv_path)):
+        return pd.read_parquet(parquet_path, engine='pyarrow')
+    return read_csv(csv_path)
+
+@functools.lru_cache(maxsize=None)
+def build_loader(group, kind, download_new=True, directory=directory,
+                 use_http_cache=True):
+    """
+    Builds a function that reads one raw dataset, with its url or file
+    paths and the choice of source worked out up front. Each combination
+    of arguments is only built once and then reused.
+
+    Parameters
+    ----------
+    group : "world" or "usa"
+
+    kind : "deaths" or "cases"
+
+    download_new : download from GitHub rather than read from directory
+
+    directory : string name of directory with the local files
+
+    use_http_cache : revalidate downloads against the cached copies
+
+    Returns
+    -------
+    function taking no arguments and returning a raw DataFrame
+    """
+    if download_new:
+        url, cache_path = data_source(group, kind)
+        if use_http_cache:
+            return functools.partial(fetch, url, cache_path)
+        return functools.partial(download, url)
+    base = pathlib.Path(directory) / f'{group}_{kind}'
+    return functools.partial(read_local, base.with_suffix('.parquet'),
+                             base.with_suffix('.csv'))
+
+async def _fetch_async(session, url, cache_path):
+    headers = _conditional_headers(url, cache_path) if cache_path else {}
+    async with session.get(url, headers=headers) as resp:
+        if resp.status == 304:
+            return cache_path
+        resp.raise_for_status()
+        body = await resp.read()
+    if cache_path is None:
+        return io.BytesIO(body)
+    _store(url, cache_path, body, resp.headers)
+    return cache_path
+
+async def _fetch_all(sources, use_http_cache):
+    timeout = aiohttp.ClientTimeout(total=60)
+    headers = {'Accept-Encoding': 'gzip'}
+    async with aiohttp.ClientSession(headers=headers, timeout=timeout) as session:
+        return await asyncio.gather(*[
+            _fetch_async(session, url, cache_path if use_http_cache else None)
+            for url, cache_path in sources])
+
+def fetch_all(sources, use_http_cache=True):
+    """
+    Downloads several CSVs concurrently on one event loop with aiohttp,
+    asking for gzip-compressed responses
+
+    Parameters
+    ----------
+    sources : list of (url, cache_path) pairs from `data_source`
+
+    use_http_cache : whether to revalidate against the cached copies
+    with conditional GETs
+
+    Returns
+    -------
+    list of DataFrames
+    """
+    bodies = asyncio.run(_fetch_all(sources, use_http_cache))
+    # parse once every download is in, outside the event loop
+    return [read_csv(body) for body in bodies]
+
+def _can_run_event_loop():
+    # asyncio.run can't be used inside a running loop, e.g. in Jupyter
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return aiohttp is not None
+    return False
+
 class Preparedata:
     
-    def __init__(self, download_new=True):
+    def __init__(self, download_new=True, use_http_cache=True):
         self.download_new = download_new
+        self.use_http_cache = use_http_cache
+        # results of read_all_data and run, so calling them again in the
+        # same session doesn't repeat the downloads
+        self._cache = {}
+
+    def _cached(self,key):
+        data=self._cache.get(key)
+        if data is None:
+            return None
+        # hand out copies so callers can't change what is cached
+        return {name: df.copy() for name,df in data.items()}
+
+    def _store_cache(self,key,data):
+        self._cache[key]=data
+        return {name: df.copy() for name,df in data.items()}
     
     def download_data(self,group, kind):
         """
@@ -46,10 +546,8 @@ class Preparedata:
         -------
         DataFrame
         """
-        group= 'US' if group=='usa' else 'global'
-        kind= 'confirmed' if kind=='cases' else 'deaths'
-        url=DOWNLOAD_URL.format(kind,group)
-        return pd.read_csv(url)
+        load=build_loader(group,kind,True,directory,self.use_http_cache)
+        return load()
 
     def read_all_data(self):
         """
@@ -59,15 +557,23 @@ class Preparedata:
         -------
         Dictionary of DataFrames
         """
-        data ={}
-        for group in GROUPS:
-            for kind in KINDS:
-                data[f'{group}_{kind}']= download_data(group,kind)
-        return data
-
-    def write_data(self,data, directory, **kwargs):
+        key=('read_all_data',self.use_http_cache)
+        data=self._cached(key)
+        if data is not None:
+            return data
+        jobs =[(group,kind) for group in GROUPS for kind in KINDS]
+        if _can_run_event_loop():
+            frames=fetch_all([data_source(*job) for job in jobs],self.use_http_cache)
+            data ={f'{group}_{kind}': df for (group,kind),df in zip(jobs,frames)}
+        else:
+            with ThreadPoolExecutor(max_workers=len(jobs)) as ex:
+                frames =ex.map(lambda job: self.download_data(*job),jobs)
+                data ={f'{group}_{kind}': df for (group,kind),df in zip(jobs,frames)}
+        return self._store_cache(key,data)
+
+    def write_data(self,data, directory, format='csv', **kwargs):
         """
-        Writes each raw data DataFrame to a file as a CSV
+        Writes each raw data DataFrame to a file as a CSV or Parquet
 
         Parameters
         ----------
@@ -75,19 +581,33 @@ class Preparedata:
 
         directory : string name of directory to save files i.e. "data/raw"
 
-        kwargs : extra keyword arguments for the `to_csv` DataFrame method
+        format : "csv" or "parquet". Parquet files are much faster to write
+        and read back and are picked up first by `read_local_data` unless
+        the CSV is newer
+
+        kwargs : extra keyword arguments for the `to_csv` or `to_parquet`
+        DataFrame method
 
         Returns
         -------
         None
         """
+        base=pathlib.Path(directory)
+        base.mkdir(parents=True,exist_ok=True)
+        if format=='parquet':
+            kwargs.setdefault('compression','zstd')
+            for key,value in data.items():
+                value.to_parquet(base / f'{key}.parquet',**kwargs)
+            return
         for key,value in data.items():
-            data[key].to_csv(f'{directory}/{key}.csv',**kwargs)
+            value.to_csv(base / f'{key}.csv',**kwargs)
         
 
     def read_local_data(self,group, kind, directory):
         """
-        Read in one CSV as a DataFrame from the given directory
+        Read in one file as a DataFrame from the given directory, using the
+        Parquet copy when it is at least as new as the CSV and the CSV
+        otherwise
 
         Parameters
         ----------
@@ -101,8 +621,8 @@ class Preparedata:
         -------
         DataFrame    
         """
-
-        return pd.read_csv(f'{directory}/{group}_{kind}.csv')
+        load=build_loader(group,kind,False,directory,self.use_http_cache)
+        return load()
 
     def select_columns(self,df):
         """
@@ -119,11 +639,10 @@ class Preparedata:
 
         """
         cols=df.columns
-        labels =['Country/Region','Province_State']
-        filt1 =cols.isin(labels)
-        filt2 =cols.str.count('/')==2
+        filt1 =cols.isin(LABELS)
+        filt2 =is_date_column(cols)
         filt = filt1 | filt2
-        return df.loc[:,filt]
+        return df.iloc[:,filt]
 
     def update_areas(self,df):
         """
@@ -138,7 +657,8 @@ class Preparedata:
         df : DataFrame
         """
         first_col=df.columns[0]
-        df.replace(REPLACE_AREA,inplace=True)
+        # only the label column can hold area names, so leave the counts alone
+        df[first_col]=df[first_col].map(rename_area)
         filt=df[first_col] !='US'
         df=df[filt]
         return df
@@ -156,8 +676,9 @@ class Preparedata:
         df : DataFrame
         """
         first_col =df.columns[0]
-        df=df.groupby(first_col).sum()
-        return df
+        areas,totals=group_sum(df[first_col].to_numpy(),df.iloc[:,1:].to_numpy())
+        index=pd.Index(areas,name=first_col)
+        return pd.DataFrame(totals,index=index,columns=df.columns[1:])
 
     def transpose_to_ts(self,df):
         """
@@ -171,10 +692,8 @@ class Preparedata:
         -------
         df : DataFrame
         """
-        df=df.T
-        time_series_col=df.columns[0]
-        df.index=pd.to_datetime(df.index)
-        return df
+        index=pd.to_datetime(df.columns,format=DATE_FORMAT,cache=True)
+        return pd.DataFrame(df.to_numpy().T,index=index,columns=df.index)
 
     def fix_bad_data(self,df):
         """
@@ -189,8 +708,8 @@ class Preparedata:
         -------
         DataFrame
         """
-        mask = df < df.cummax()
-        return df.mask(mask).interpolate().round(0).astype('int64')
+        values=fix_monotone(df.to_numpy())
+        return pd.DataFrame(values,index=df.index,columns=df.columns)
 
     def run(self):
         """
@@ -201,20 +720,27 @@ class Preparedata:
         Dictionary of DataFrames
         """
         directory='data/raw'
+        key=('run',self.download_new,self.use_http_cache,directory)
+        data=self._cached(key)
+        if data is not None:
+            return data
+        # one reader per dataset for the current settings, so changing
+        # download_new or use_http_cache takes effect; build_loader only
+        # builds each of them once
+        loaders ={(group,kind): build_loader(group,kind,self.download_new,
+                                             directory,self.use_http_cache)
+                  for group in GROUPS for kind in KINDS}
+        # downloads are network bound, so overlap them in threads and
+        # do the cleaning afterwards in the main thread
+        with ThreadPoolExecutor(max_workers=len(loaders)) as ex:
+            raw =dict(zip(loaders,ex.map(lambda load: load(),loaders.values())))
+
         data ={}
         for group in GROUPS:
-            for kind in KINDS:
-                if self.download_new:
-                    df=self.download_data(group,kind)
-                else:
-                    df=self.read_local_data(group,kind,directory)
-                df=self.select_columns(df)
-                df=self.update_areas(df)
-                df=self.group_area(df)
-                df=self.transpose_to_ts(df)
-                df=self.fix_bad_data(df)
+            frames=clean_group([raw[group,kind] for kind in KINDS])
+            for kind,df in zip(KINDS,frames):
                 data[f'{group}_{kind}']=df
-        return data
+        return self._store_cache(key,data)
 
         
 